@@ -1,47 +1,151 @@
-import requests
-import pandas as pd
+import asyncio
+import os
+from pathlib import Path
+import aiohttp
+import orjson
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+import pyarrow as pa
+import pyarrow.compute as pc
 import duckdb
 
-def extract_data(limit=10, last_id=None) -> tuple:
+MAX_PAGE_LIMIT = 1000
+CACHE_EXPIRE_SECONDS = 86400
+MAX_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.2
+DEBUG = os.environ.get("POKEDEX_DEBUG") == "1"
+DATA_DIR = Path("data")
+RESULTS_SCHEMA = pa.schema([("name", pa.string()), ("url", pa.string())])
+STAGING_SCHEMA = RESULTS_SCHEMA.append(pa.field("pokemon_id", pa.int64()))
+LOAD_SCHEMA = STAGING_SCHEMA.append(pa.field("last_id", pa.int32()))
+
+def create_metadata(conn):
+    """Creates the keyed metadata table, migrating the old single-column layout."""
+    has_key = conn.execute("""
+        SELECT COUNT(*) FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND table_name = 'metadata' AND column_name = 'id'
+    """).fetchone()[0]
+    if has_key:
+        return
+    
+    legacy = conn.execute("""
+        SELECT COUNT(*) FROM information_schema.tables
+        WHERE table_schema = current_schema() AND table_name = 'metadata'
+    """).fetchone()[0]
+    conn.execute("BEGIN")
+    try:
+        migrate_metadata(conn, legacy)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def migrate_metadata(conn, legacy):
+    """Replaces a legacy metadata table with the keyed layout, keeping its checkpoint."""
+    if legacy:
+        conn.execute("ALTER TABLE metadata RENAME TO metadata_legacy")
+    conn.execute("CREATE TABLE metadata (id INTEGER PRIMARY KEY, last_id INTEGER)")
+    if legacy:
+        conn.execute("""
+            INSERT INTO metadata
+            SELECT 1, MAX(last_id) FROM metadata_legacy HAVING MAX(last_id) IS NOT NULL
+        """)
+        conn.execute("DROP TABLE metadata_legacy")
+
+def get_last_id(conn) -> int:
+    """Returns the last extracted ID stored in the metadata table."""
+    return conn.execute("SELECT COALESCE(MAX(last_id), 0) FROM metadata").fetchone()[0]
+
+async def fetch_page(session, limit, offset) -> dict:
+    """
+    Fetches one page of Pokemon from PokeAPI and returns the JSON body.
+    Connection errors, timeouts and 5xx responses are retried up to MAX_RETRIES times
+    with exponential backoff.
+    """
+    url = f"https://pokeapi.co/api/v2/pokemon?limit={limit}&offset={offset}"
+    print(f"Getting data from: {url}")
+    
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                response.raise_for_status()
+                return orjson.loads(await response.read())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            client_error = isinstance(e, aiohttp.ClientResponseError) and e.status < 500
+            if client_error or attempt == MAX_RETRIES:
+                print(f"Failed to fetch data: {e!r}")
+                raise
+            await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+async def fetch_all(session, total, offset) -> list:
+    """
+    Fetches `total` Pokemon starting at `offset` in as few requests as possible.
+    A single request is issued when `total` fits under the server page cap,
+    otherwise the range is split into capped pages fetched concurrently.
+    Returns one list of results per page.
+    """
+    if total <= MAX_PAGE_LIMIT:
+        data = await fetch_page(session, total, offset)
+        return [data["results"]]
+    
+    pages = await asyncio.gather(*[
+        fetch_page(session, min(MAX_PAGE_LIMIT, total - start), offset + start)
+        for start in range(0, total, MAX_PAGE_LIMIT)
+    ])
+    return [page["results"] for page in pages]
+
+def to_arrow(results) -> pa.RecordBatch:
+    """Builds an Arrow record batch of name, url and pokemon_id from one page of results."""
+    batch = pa.RecordBatch.from_pylist(results, schema=RESULTS_SCHEMA)
+    matches = pc.extract_regex(batch.column("url"), pattern=r"/pokemon/(?P<id>\d+)/")
+    ids = pc.cast(pc.struct_field(matches, "id"), pa.int64())
+    return pa.RecordBatch.from_arrays([*batch.columns, ids], schema=STAGING_SCHEMA)
+
+async def extract_data(session, conn, total=10, last_id=None) -> tuple:
     """
-    Extracts Pokemon data from PokeAPI and saves it as a Parquet file.
+    Extracts Pokemon data from PokeAPI into in-memory Arrow record batches.
     Arguments:
-        limit (int): Number of records to fetch per request. Default is 10.
+        session (aiohttp.ClientSession): Shared HTTP session.
+        conn (duckdb.DuckDBPyConnection): Pipeline DuckDB connection.
+        total (int): Number of records to fetch. Default is 10.
         last_id (int): The ID to start fetching from. Default is None.
     Returns:
-        tuple: (file_path, next_id)
+        tuple: (batches, next_id)
     """
-    conn = duckdb.connect("pokedex.duckdb")
-    conn.execute("CREATE TABLE IF NOT EXISTS metadata (last_id INTEGER)")
-    
     if last_id is None:
-        last_id = conn.execute("SELECT COALESCE(MAX(last_id), 0) FROM metadata").fetchone()[0]
-    conn.close()
+        last_id = get_last_id(conn)
     
-    url = f"https://pokeapi.co/api/v2/pokemon?limit={limit}&offset={last_id}"
-    print(f"Getting data from: {url}")
+    pages = await fetch_all(session, total, last_id)
+    batches = [to_arrow(results) for results in pages]
+    if DEBUG:
+        print("Preview extracted data:", batches[0].slice(0, 5).to_pydict())
     
+    return batches, last_id + total
+
+def load_data(batches, new_last_id, conn):
+    """
+    Loads Arrow record batches of Pokemon data into DuckDB in a single transaction.
+    Each batch carries its own last_id column (see BufferedLoader.add); `new_last_id`
+    is the checkpoint stored in metadata once the load commits.
+    """
+    conn.execute("BEGIN")
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        print(f"Failed to fetch data: {e}")
+        load_batch(batches, new_last_id, conn)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
         raise
     
-    data = response.json()
-    df = pd.DataFrame(data["results"])
-    table = duckdb.from_df(df).to_arrow_table()
-    print("Preview extracted data:", table.to_pandas().head())
-    
-    file_path = f"pokedex_{str(last_id).zfill(3)}.parquet"
-    duckdb.from_arrow(table).write_parquet(file_path)
-    print(f"Saved to: {file_path}")
+    if DEBUG:
+        preview = conn.execute("""
+            SELECT * FROM pokedex WHERE last_id = ?
+        """, [new_last_id]).fetchmany(5)
+        print("Preview loaded data:", preview)
     
-    return file_path, last_id + limit
+    print("Data loaded successfully")
 
-def load_data(file_path, new_last_id):
-    """Loads Pokemon data from a Parquet file into DuckDB."""
-    conn = duckdb.connect("pokedex.duckdb")
+def create_tables(conn):
+    """Creates the pokedex and metadata tables the load writes to."""
     conn.execute(""" 
                     CREATE TABLE IF NOT EXISTS pokedex 
                     (last_id INTEGER, 
@@ -49,32 +153,61 @@ def load_data(file_path, new_last_id):
                     name TEXT, 
                     url TEXT)
                 """)
-    
+    create_metadata(conn)
+
+def load_batch(batches, new_last_id, conn):
+    """Inserts the batch and advances the metadata checkpoint."""
+    conn.register("staging", pa.Table.from_batches(batches, schema=LOAD_SCHEMA))
     conn.execute("""
         INSERT INTO pokedex 
-        SELECT 
-            ?, 
-            CAST(regexp_extract(url, '/pokemon/(\d+)/', 1) AS INTEGER), 
-            name, 
-            url
-        FROM read_parquet(?)
-    """, [new_last_id, file_path])
+        SELECT last_id, pokemon_id, name, url
+        FROM staging
+    """)
     
-    preview_df = conn.execute("""
-        SELECT * FROM pokedex WHERE last_id = ? LIMIT 3
-    """, [new_last_id]).fetchdf()
-    print("Preview loaded data:", preview_df)
+    conn.execute("""
+        INSERT INTO metadata VALUES (1, ?)
+        ON CONFLICT (id) DO UPDATE SET last_id = excluded.last_id
+    """, [new_last_id])
+
+class BufferedLoader:
+    """
+    Buffers extracted Arrow record batches and loads them into DuckDB in one go once
+    `flush_threshold_rows` rows are pending, or when flush() is called.
+    """
+    def __init__(self, conn, flush_threshold_rows=50000):
+        self.conn = conn
+        self.flush_threshold_rows = flush_threshold_rows
+        self.batches = []
+        self.rows = 0
+        self.last_id = None
     
-    conn.execute("UPDATE metadata SET last_id = ? WHERE last_id IS NOT NULL", [new_last_id])
-    if conn.execute("SELECT COUNT(*) FROM metadata").fetchone()[0] == 0:
-        conn.execute("INSERT INTO metadata VALUES (?)", [new_last_id])
+    def add(self, batches, new_last_id):
+        """
+        Buffers record batches stamped with `new_last_id`, flushing if the row
+        threshold is reached.
+        """
+        self.batches.extend(
+            pa.RecordBatch.from_arrays(
+                [*batch.columns, pa.array([new_last_id] * batch.num_rows, pa.int32())],
+                schema=LOAD_SCHEMA,
+            )
+            for batch in batches
+        )
+        self.rows += sum(batch.num_rows for batch in batches)
+        self.last_id = new_last_id
+        if self.rows >= self.flush_threshold_rows:
+            self.flush()
     
-    print("Data loaded successfully")
-    conn.close()
+    def flush(self):
+        """Loads all buffered batches with a single INSERT."""
+        if not self.batches:
+            return
+        load_data(self.batches, self.last_id, self.conn)
+        self.batches = []
+        self.rows = 0
 
-def transform_data():
+def transform_data(conn):
     """Creates aggregated statistics for Pokemon data."""
-    conn = duckdb.connect("pokedex.duckdb")
     conn.execute("""
         CREATE OR REPLACE TABLE pokemon_stats AS
         SELECT 
@@ -84,23 +217,62 @@ def transform_data():
         FROM pokedex
     """)
     
-    df = conn.execute("SELECT * FROM pokemon_stats").fetchdf()
-    print("Preview transformed data:", df)
+    if DEBUG:
+        preview = conn.execute("SELECT * FROM pokemon_stats").fetchmany(5)
+        print("Preview transformed data:", preview)
     # return "pokemon_stats"
 
-def main():
-    print("Extracting data...")
-    file_path_1, new_last_id_1 = extract_data(limit=30, last_id=None)
-    file_path_2, new_last_id_2 = extract_data(limit=30, last_id=new_last_id_1)
+def export_parquet(conn, last_id=None, file_path=None, per_thread_output=False):
+    """
+    Exports the pokedex table to Parquet for downstream consumers.
+    Defaults to data/pokedex_<last_id>.parquet. With `per_thread_output`, each
+    thread writes its own file into the directory data/pokedex_<last_id>
+    (or `file_path`), overwriting files from a previous export.
+    """
+    if file_path is None:
+        if last_id is None:
+            raise ValueError("last_id is required when file_path is not given")
+        suffix = "" if per_thread_output else ".parquet"
+        file_path = DATA_DIR / f"pokedex_{last_id:010d}{suffix}"
+        DATA_DIR.mkdir(exist_ok=True)
     
-    print("Loading data...")
-    load_data(file_path_1, new_last_id_1)
-    load_data(file_path_2, new_last_id_2)
-  
-    print("Transforming data...")
-    transform_data()
+    options = "FORMAT PARQUET, COMPRESSION 'zstd', COMPRESSION_LEVEL 3, ROW_GROUP_SIZE 100000"
+    if per_thread_output:
+        options += ", PER_THREAD_OUTPUT true, OVERWRITE_OR_IGNORE true"
+    quoted_path = str(file_path).replace("'", "''")
+    conn.execute(f"COPY pokedex TO '{quoted_path}' ({options})")
+    print(f"Saved to: {file_path}")
+
+async def main(total=60, export=False):
+    conn = duckdb.connect("pokedex.duckdb")
+    conn.execute(f"PRAGMA threads={os.cpu_count() or 1}")
+    conn.execute("PRAGMA memory_limit='2GB'")
+    # The staging INSERT and the Parquet COPY have no ORDER BY, so both may run unordered
+    conn.execute("SET preserve_insertion_order = false")
+    try:
+        create_tables(conn)
+        
+        print("Extracting data...")
+        cache = SQLiteBackend("pokeapi_cache", expire_after=CACHE_EXPIRE_SECONDS)
+        connector = aiohttp.TCPConnector(limit=16, limit_per_host=16, keepalive_timeout=30)
+        async with CachedSession(cache=cache, connector=connector) as session:
+            batches, new_last_id = await extract_data(session, conn, total=total)
+        
+        print("Loading data...")
+        loader = BufferedLoader(conn)
+        loader.add(batches, new_last_id)
+        loader.flush()
+      
+        print("Transforming data...")
+        transform_data(conn)
+        
+        if export:
+            print("Exporting data...")
+            export_parquet(conn, last_id=new_last_id)
+    finally:
+        conn.close()
   
     print("ELT Pipeline completed successfully!")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file